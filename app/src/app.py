@@ -16,32 +16,46 @@ import os
 
 import yaml
 import psycopg2
+import psycopg2.pool
 import boto
 
 import plots
 
 from spyre import server
 
+# use the libyaml parser when it's available
+try:
+    from yaml import CSafeLoader as SafeLoader
+
+except ImportError:
+    from yaml import SafeLoader
+
 
 class ForexApp(server.App):
     def __init__(self):
         self.data_cache = None
         self.param_cache = None
 
-        credentials = yaml.load(open(os.path.expanduser('../postgres_credentials.yml')))
+        with open(os.path.expanduser('../postgres_credentials.yml')) as f:
+            credentials = yaml.load(f, Loader=SafeLoader)
 
         PG_ENDPOINT = 'forex-data.cql5yf8qc4xa.us-east-1.rds.amazonaws.com'
         PG_DB_NAME = credentials['postgres']['db_name']
         PG_USERNAME = credentials['postgres']['username']
         PG_PASSWORD = credentials['postgres']['password']
 
-        self.pg_conn = psycopg2.connect(host=PG_ENDPOINT, user=PG_USERNAME, password=PG_PASSWORD, dbname=PG_DB_NAME)
-        self.pg_cursor = self.pg_conn.cursor()
+        # pool of connections so concurrent requests don't share a cursor
+        self.pg_pool = psycopg2.pool.ThreadedConnectionPool(minconn=4, maxconn=25, host=PG_ENDPOINT, user=PG_USERNAME,
+                                                            password=PG_PASSWORD, dbname=PG_DB_NAME)
 
         s3_conn = boto.connect_s3()
 
         self.bucket = s3_conn.get_bucket('forex-processed-data')
 
+        # the info page is static, so it's only read once
+        with open("info.html") as f:
+            self.info_page = f.read()
+
     inputs = [{"type": "dropdown",
                "label": "Currency One",
                "options": [{"label": "Euro (EU)", "value": "eur"},
@@ -119,16 +133,22 @@ class ForexApp(server.App):
 
     def getPlot(self, params):
         if params['data_range'] == 'historical':
-            return plots.plot_historical_data(params, self.pg_cursor, self.pg_conn)
+            # check out a connection for the duration of this request
+            pg_conn = self.pg_pool.getconn()
+
+            try:
+                pg_cursor = pg_conn.cursor()
+
+                return plots.plot_historical_data(params, pg_cursor, pg_conn)
+
+            finally:
+                self.pg_pool.putconn(pg_conn)
 
         if params['data_range'] == 'daily':
             return plots.plot_daily_data(params, self.bucket)
 
     def getHTML(self, params):
-        with open("info.html") as f:
-            info_page = f.read()
-
-        return info_page
+        return self.info_page
 
 
 if __name__ == '__main__':
@@ -5,13 +5,68 @@ Historical and daily plotting functions for the Spyre app.
 
 import time
 import io
-import pytz
+import functools
+import threading
+import zoneinfo
 
-import matplotlib.pyplot as plt
+import cachetools
+import matplotlib
+import numpy as np
 import pandas as pd
 import psycopg2
 
 from datetime import datetime, timedelta
+from matplotlib.figure import Figure
+from psycopg2 import sql
+
+
+# plots are only ever rendered to images, so skip interactive backend selection
+matplotlib.use('Agg')
+
+# formats a user may enter a date in
+DATE_FORMATS = ("%Y/%m/%d", "%Y-%m-%d", "%Y %m %d")
+
+# columns of the historical tables that can be plotted
+HISTORICAL_VALUES = ('open_bid', 'open_ask', 'max_bid', 'max_ask', 'min_bid', 'min_ask', 'close_bid', 'close_ask')
+
+# today's CSV is still being appended to, so it's only reused for a minute
+TODAYS_DATA_CACHE = cachetools.TTLCache(maxsize=32, ttl=60)
+
+# older CSVs don't change, so they're kept until evicted
+PAST_DATA_CACHE = cachetools.LRUCache(maxsize=64)
+
+# historical data only gains a row per day from the batch job
+HISTORICAL_DATA_CACHE = cachetools.TTLCache(maxsize=128, ttl=3600)
+
+# most points a line is drawn with, more than this isn't visible at the size plots are shown
+MAX_PLOT_POINTS = 2000
+
+# daily data is stored on S3 in Pacific Time
+PT = zoneinfo.ZoneInfo("US/Pacific")
+UTC = zoneinfo.ZoneInfo("UTC")
+
+# cachetools caches aren't thread safe and the server handles requests concurrently
+CACHE_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_date(date_str):
+    """
+    Parses a date string in any of the accepted formats. Memoized, since the same
+    couple of dates are sent with every plot request.
+
+    :param date_str: user input string for the date
+    :return: datetime object, or None if the string isn't a valid date
+    """
+
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str, date_format)
+
+        except ValueError:
+            continue
+
+    return None
 
 
 def check_date_viability(date_str):
@@ -25,16 +80,12 @@ def check_date_viability(date_str):
     :return: datetime object
     """
 
-    possible_formats = ["%Y/%m/%d", "%Y-%m-%d", "%Y %m %d"]
-
-    for date_format in possible_formats:
-        try:
-            return datetime.strptime(date_str, date_format)
+    date = parse_date(date_str)
 
-        except ValueError:
-            continue
+    if date is None:
+        raise ValueError
 
-    raise ValueError
+    return date
 
 
 def get_historical_data(instrument_name, params, pg_cursor, pg_conn):
@@ -50,59 +101,135 @@ def get_historical_data(instrument_name, params, pg_cursor, pg_conn):
     :return: pyplot figure.
     """
 
-    # get all parameters in proper format and
-    data_to_pull = ", ".join(params['values_to_show'])
+    # only pull columns that actually exist in the tables
+    values_to_show = [value for value in params['values_to_show'] if value in HISTORICAL_VALUES]
 
-    # validate both date blocks
+    # validate both date blocks, open ended ranges use infinity so the query text never changes
     try:
-        start_date = check_date_viability(params['start_date'])
+        start_date = check_date_viability(params['start_date']).date()
 
     except ValueError:
-        start_date = None
+        start_date = '-infinity'
 
     try:
-        end_date = check_date_viability(params['end_date'])
+        end_date = check_date_viability(params['end_date']).date()
 
     except ValueError:
-        end_date = None
+        end_date = 'infinity'
 
     # only do anything if data was actually provided
-    if data_to_pull:
+    if values_to_show:
 
-        # create SQL query
-        if start_date and end_date:
-            SQL_query = "SELECT date, {} FROM {} WHERE date >= '{}' AND date <= '{}' ORDER BY date" \
-             .format(data_to_pull, instrument_name, str(start_date), str(end_date))
+        cache_key = (instrument_name, tuple(values_to_show), start_date, end_date)
 
-        elif start_date:
-            SQL_query = "SELECT date, {} FROM {} WHERE date >= '{}' ORDER BY date" \
-             .format(data_to_pull, instrument_name, str(start_date))
+        with CACHE_LOCK:
+            data_series = HISTORICAL_DATA_CACHE.get(cache_key)
 
-        elif end_date:
-            SQL_query = "SELECT date, {} FROM {} WHERE date <= '{}' ORDER BY date" \
-             .format(data_to_pull, instrument_name, str(end_date))
+        if data_series is not None:
+            return data_series
 
-        else:
-            SQL_query = "SELECT date, {} FROM {} ORDER BY date" \
-             .format(data_to_pull, instrument_name)
+        # create SQL query
+        SQL_query = sql.SQL("SELECT date, {cols} FROM {tbl} WHERE date BETWEEN %s AND %s ORDER BY date") \
+            .format(cols=sql.SQL(", ").join(map(sql.Identifier, values_to_show)), tbl=sql.Identifier(instrument_name))
 
         try:
             # execute the query
-            pg_cursor.execute(SQL_query)
+            pg_cursor.execute(SQL_query, (start_date, end_date))
+
+            # preallocate one array per column, dates first and then the prices
+            n_rows = pg_cursor.rowcount
+            data_series = [np.empty(n_rows, dtype=object)] + [np.empty(n_rows, dtype=np.float64) for _ in values_to_show]
+
+            # fill the columns directly from the response in chunks
+            offset = 0
+            chunk = pg_cursor.fetchmany(10000)
+
+            while chunk:
+                for column, values in zip(data_series, zip(*chunk)):
+                    column[offset:offset + len(chunk)] = values
+
+                offset += len(chunk)
+                chunk = pg_cursor.fetchmany(10000)
 
-            # format response into a list of lists
-            data_series = list(zip(*list(pg_cursor)))
+            # the columns are shared through the cache, so lock them
+            for column in data_series:
+                column.flags.writeable = False
+
+            data_series = tuple(data_series)
+
+            with CACHE_LOCK:
+                HISTORICAL_DATA_CACHE[cache_key] = data_series
 
             return data_series
 
-        except psycopg2.ProgrammingError:
+        except psycopg2.Error:
+            # don't hand an aborted transaction back to the pool
             pg_conn.rollback()
 
 
+def downsample(x, y, n_out=MAX_PLOT_POINTS):
+    """
+    Picks the points of a line that keep its visual shape using Largest Triangle Three Buckets.
+
+    :param x: dates or datetimes of the line
+    :param y: values of the line
+    :param n_out: number of points to keep
+    :return: indices of the points to keep
+    """
+
+    n_points = len(y)
+
+    if n_points <= n_out or n_out < 3:
+        return np.arange(n_points)
+
+    # LTTB works on the area between points, so the dates need to be numbers
+    x = np.asarray(x, dtype='datetime64[s]').astype(np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # the first and last points are always kept, everything in between is split into buckets
+    edges = np.linspace(1, n_points - 1, n_out - 1).astype(np.int64)
+
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n_points - 1
+
+    last_picked = 0
+
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+
+        # average of the next bucket, which is just the last point for the final bucket
+        next_end = edges[i + 2] if i + 2 < len(edges) else n_points
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+
+        # keep the point making the largest triangle with the last kept point and the next average
+        areas = np.abs((x[last_picked] - next_x) * (y[start:end] - y[last_picked])
+                       - (x[last_picked] - x[start:end]) * (next_y - y[last_picked]))
+
+        last_picked = start + np.argmax(areas)
+        indices[i + 1] = last_picked
+
+    return indices
+
+
 def plot_one_data_series(axs, dates, data_series, instrument_name, values_to_show):
-    # plot all data
-    for data, data_name in zip(data_series[1:], values_to_show):
-        axs.plot(dates, data, label=instrument_name.upper() + "_" + data_name)
+    dates = np.asarray(dates)
+
+    # one column per value to show
+    values = np.column_stack(data_series[1:])
+
+    # the series are drawn together so they share one set of points, made of every point
+    # any of them needs to keep its shape; each gets an equal share of the point budget
+    n_out = MAX_PLOT_POINTS // values.shape[1]
+    indices = np.unique(np.concatenate([downsample(dates, values[:, i], n_out)
+                                        for i in range(values.shape[1])]))
+
+    # plot all data in one call
+    lines = axs.plot(dates[indices], values[indices])
+
+    for line, data_name in zip(lines, values_to_show):
+        line.set_label(instrument_name.upper() + "_" + data_name)
 
     return axs
 
@@ -119,7 +246,7 @@ def plot_historical_data(params, pg_cursor, pg_conn):
     :return: pyplot figure
     """
 
-    fig = plt.figure()
+    fig = Figure()
     axs = fig.add_subplot(1, 1, 1)
 
     # grab the data needed
@@ -149,62 +276,89 @@ def plot_historical_data(params, pg_cursor, pg_conn):
     return fig
 
 
-def dataframe_from_s3_csv(bucket, s3_dir):
+def read_s3_csv(bucket, s3_dir):
     """
     Parses a CSV file to a DataFrame without writing to disk.
 
+    :param bucket: S3 bucket where the CSV is located
     :param s3_dir: directory to CSV file on S3
-    :return: pandas dataframe
+    :return: pandas dataframe, empty if the file doesn't exist
     """
 
     # connect to bucket and get the CSV
     key = bucket.get_key(s3_dir)
-    CSV_as_string = key.get_contents_as_string()
 
-    # pretend the string is a file
-    fake_file = io.StringIO()
-    fake_file.write(CSV_as_string.decode())
-    fake_file.seek(0)
+    # a day's file doesn't exist until its first records are flushed
+    if key is None:
+        return pd.DataFrame({'instrument': pd.Series(dtype=object),
+                             'datetime': pd.Series(dtype=pd.DatetimeTZDtype(tz=PT)),
+                             'bid': pd.Series(dtype=np.float64),
+                             'ask': pd.Series(dtype=np.float64)})
 
-    return pd.read_csv(fake_file, header=None)
+    # the CSV is parsed straight from the raw bytes into typed columns
+    df = pd.read_csv(io.BytesIO(key.get_contents_as_string()), header=None,
+                     names=['instrument', 'datetime', 'bid', 'ask'],
+                     dtype={'bid': np.float64, 'ask': np.float64}, engine='c')
 
+    # time stamps carry their UTC offset, which changes during the day when daylight saving time
+    # starts or ends, so they're parsed to UTC instants before converting to Pacific Time
+    df['datetime'] = pd.to_datetime(df['datetime'], format="%Y-%m-%d %H:%M%z", utc=True).dt.tz_convert(PT)
 
-def clean_up_dataframe(df):
+    return df
+
+
+def dataframe_from_s3_csv(bucket, s3_dir, after=None, cache=PAST_DATA_CACHE):
     """
-    Cleans up a daily data DataFrame as pulled from S3.
-    Adds columns, converts strings to floats, sets values as means for repeated time keys,
-    and converts datetime string to datetime object.
+    Gets the DataFrame for a CSV file on S3, reusing a previous parse if it's still cached.
 
-    :param df: uncleaned dataframe
-    :return: df: cleaned dataframe.
+    :param bucket: S3 bucket where the CSV is located
+    :param s3_dir: directory to CSV file on S3
+    :param after: optional datetime, only rows with a timestamp later than this are kept
+    :param cache: cache the parsed CSV is stored in
+    :return: pandas dataframe
     """
 
-    df.columns = ['instrument', 'datetime', 'bid', 'ask']
+    # buckets aren't hashable, so key on the bucket name instead
+    cache_key = (bucket.name, s3_dir)
 
-    df['bid'] = df['bid'].apply(float)
-    df['ask'] = df['ask'].apply(float)
+    with CACHE_LOCK:
+        df = cache.get(cache_key)
 
-    df = df.groupby(['instrument', 'datetime']).mean().reset_index()
+    if df is None:
+        df = read_s3_csv(bucket, s3_dir)
 
-    df['datetime'] = df['datetime'].apply(lambda time_str: datetime.strptime(time_str, "%Y-%m-%d %H:%M"))
+        # a missing file may show up at any moment, so only cache ones that were found
+        if not df.empty:
+            with CACHE_LOCK:
+                cache[cache_key] = df
 
-    return df
+    # drop old rows before any of the more expensive cleaning happens
+    if after is not None:
+        return df[df['datetime'] > after].copy()
+
+    # callers modify the dataframe, so never hand out the cached one
+    return df.copy()
 
 
-def time_convert(datetime_obj, zone_one='UTC', zone_two='US/Pacific'):
+def clean_up_dataframe(df):
     """
-    Converts a naive datetime object from zone_one to zone_two.
-    Defaults to UTC -> Pacific
+    Cleans up a daily data DataFrame as pulled from S3.
+    Sets values as means for repeated time keys.
 
-    :param datetime_obj: datetime object to convert
-    :param zone_one: current time zone of the object
-    :param zone_two: target time zone of the object
-    :return: datetime object converted to the target timezone.
+    :param df: uncleaned dataframe
+    :return: df: cleaned dataframe.
     """
 
-    datetime_obj = pytz.timezone(zone_one).localize(datetime_obj)
+    df = df.sort_values(['instrument', 'datetime'])
+
+    # repeated time keys are rare, so only those rows go through the groupby
+    duplicated = df.duplicated(['instrument', 'datetime'], keep=False)
 
-    return datetime_obj.astimezone(pytz.timezone(zone_two))
+    if duplicated.any():
+        means = df[duplicated].groupby(['instrument', 'datetime'], as_index=False).mean()
+        df = pd.concat([df[~duplicated], means]).sort_values(['instrument', 'datetime'])
+
+    return df.reset_index(drop=True)
 
 
 def plot_daily_data(params, bucket):
@@ -223,11 +377,11 @@ def plot_daily_data(params, bucket):
 
     timestamp_now = time.time()
 
-    UTC_time_now = datetime.utcfromtimestamp(timestamp_now)
+    UTC_time_now = datetime.fromtimestamp(timestamp_now, tz=UTC)
 
     UTC_time_one_day_ago = UTC_time_now - timedelta(days=1)
 
-    fig = plt.figure()
+    fig = Figure()
     axs = fig.add_subplot(1, 1, 1)
 
     axs = plot_one_instrument_daily(axs, instrument_one, bucket, UTC_time_now, UTC_time_one_day_ago)
@@ -235,6 +389,9 @@ def plot_daily_data(params, bucket):
     if instrument_two != "NO_THANKS":
         axs = plot_one_instrument_daily(axs, instrument_two, bucket, UTC_time_now, UTC_time_one_day_ago)
 
+    # label the time axis in Pacific Time
+    axs.xaxis_date(tz=PT)
+
     for tick in axs.get_xticklabels():
         tick.set_rotation(45)
 
@@ -256,33 +413,33 @@ def plot_one_instrument_daily(axs, instrument_name, bucket, UTC_time_now, UTC_ti
     """
 
     # get s3 bucket with the data from today
-    first_key = "{}/{}/{}/{}/TODAYS-DATA.csv"\
+    first_key = "{}/{}/{}/{}/TODAYS-DATA-PT.csv"\
                 .format(instrument_name, *UTC_time_now.strftime("%Y %m %d").split())
 
     # get s3 bucket with the data from yesterday
-    second_key = "{}/{}/{}/{}/TODAYS-DATA.csv"\
+    second_key = "{}/{}/{}/{}/TODAYS-DATA-PT.csv"\
                 .format(instrument_name, *UTC_time_one_day_ago.strftime("%Y %m %d").split())
 
-    # parse CSV files and clean up the dataframes
-    df_one = dataframe_from_s3_csv(bucket, first_key)
-    df_two = dataframe_from_s3_csv(bucket, second_key)
+    # parse CSV files, getting rid of anything that's older than 24 hours ago
+    df_one = dataframe_from_s3_csv(bucket, first_key, cache=TODAYS_DATA_CACHE)
+    df_two = dataframe_from_s3_csv(bucket, second_key, after=UTC_time_one_day_ago)
 
+    # clean up the dataframes
     df_one = clean_up_dataframe(df_one)
     df_two = clean_up_dataframe(df_two)
 
-    # get rid of anything that's older than 24 hours ago
-    df_two = df_two[df_two['datetime'] > UTC_time_one_day_ago]
-
-    # concatenate the two dataframes and convert to local time
+    # concatenate the two dataframes
     final_df = pd.concat([df_two, df_one])
-    final_df['datetime'] = final_df['datetime'].apply(lambda x: time_convert(x))
 
-    x = final_df['datetime']
-    y1 = final_df['bid']
-    y2 = final_df['ask']
+    x = final_df['datetime'].values
+    y1 = final_df['bid'].values
+    y2 = final_df['ask'].values
 
     # instantiate matplotlib objects and plot
-    axs.plot(x, y1, label=instrument_name + "_bid")
-    axs.plot(x, y2, label=instrument_name + "_ask")
+    bid_indices = downsample(x, y1)
+    ask_indices = downsample(x, y2)
+
+    axs.plot(x[bid_indices], y1[bid_indices], label=instrument_name + "_bid")
+    axs.plot(x[ask_indices], y2[ask_indices], label=instrument_name + "_ask")
 
     return axs
@@ -7,11 +7,18 @@ the ask price.
 
 The data will be written to a file on S3 with the format:
 
-s3://forex-data-processed/INSTRUMENT_NAME/YEAR/MONTH/DAY
+s3://forex-data-processed/INSTRUMENT_NAME/YEAR/MONTH/DAY/TODAYS-DATA-PT.csv
+
+where the day is the UTC day and the time stamps inside are in Pacific Time,
+written with their UTC offset so times in the repeated hour at the end of
+daylight saving time stay distinct.
 """
 
 import json
+import zoneinfo
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import boto
@@ -21,11 +28,25 @@ from boto import kinesis
 from kinesis import KinesisConsumer
 
 
+# time zones are only looked up once
+PT = zoneinfo.ZoneInfo("US/Pacific")
+UTC = zoneinfo.ZoneInfo("UTC")
+
+# record time stamps are UNIX epoch in microseconds
+MICROSECONDS_PER_DAY = 86400 * 1000000
+
+
 class ForexConsumerProcessed(KinesisConsumer):
 
     def __init__(self, client, sleep_period, shard_id, stream_name, record_limit, begin_read, bucket):
         super(ForexConsumerProcessed, self).__init__(client, sleep_period, shard_id, stream_name, record_limit, begin_read)
         self.bucket = bucket
+        # workers for writing each instrument's CSV concurrently
+        self.flush_executor = ThreadPoolExecutor(max_workers=16)
+        # keys this process has already written, which don't need an existence check
+        self.known_keys = set()
+        # S3 key paths by (instrument, UTC day)
+        self.key_path_cache = {}
 
     def check_record_validity(self, record):
         """
@@ -35,14 +56,26 @@ class ForexConsumerProcessed(KinesisConsumer):
         :return: True if it's valid, False if it's not
         """
 
+        data = record['Data']
+
+        # the prices key won't exist if the record is bad, which can be seen without parsing it
+        if (b'"prices"' if isinstance(data, bytes) else '"prices"') not in data:
+            return False
+
         try:
-            # the prices key won't exist if the record is bad
-            json.loads(record['Data'])['prices'][0]
-            return True
+            exchange_data_json = json.loads(data)
+
+        except ValueError:
+            return False
 
-        except KeyError:
+        if not exchange_data_json.get('prices'):
             return False
 
+        # keep the parsed record around so process_record doesn't parse it again
+        record['_parsed'] = exchange_data_json
+
+        return True
+
     def process_record(self, record):
         """
         Takes the json object returned by the API endpoint and returns it in the format we want in our database.
@@ -51,7 +84,7 @@ class ForexConsumerProcessed(KinesisConsumer):
         :return list with format [ticker_name, rate_time, bid, ask]
         """
 
-        exchange_data_json = json.loads(record['Data'])
+        exchange_data_json = record.get('_parsed') or json.loads(record['Data'])
 
         instrument_data = exchange_data_json['prices'][0]
 
@@ -72,42 +105,77 @@ class ForexConsumerProcessed(KinesisConsumer):
 
         return ticker_name, rate_time, bid, ask
 
-    def send_record(self, processed_record):
+    def format_record(self, processed_record):
         """
-        Appends processed record to the CSV on S3.
+        Formats a processed record as a CSV row and finds the S3 key it belongs to.
 
         :param processed_record: instrument data in format [instrument_name, unix_time, bid_price, ask_price]
-        :return: void
+        :return: key path in format INSTRUMENT_NAME/YEAR/MONTH/DAY/TODAYS-DATA-PT.csv, CSV row
         """
 
         # pull out the name of the instrument
         instrument_name = processed_record[0]
-        UNIX_time = processed_record[1]
+        UNIX_time = int(processed_record[1])
 
-        # get time
-        record_time = datetime.fromtimestamp(int(int(UNIX_time) / 1000000)).strftime("%Y-%m-%d %H:%M")
-        time_list = record_time.split()[0].split("-")
-
-        # convert to normal time in the list
-        instrument_data_list = list(processed_record)
-        instrument_data_list[1] = record_time
+        # get time, the file is picked by UTC day but the time stamp is stored in Pacific Time
+        record_datetime = datetime.fromtimestamp(UNIX_time // 1000000, tz=UTC)
+        record_time = record_datetime.astimezone(PT).strftime("%Y-%m-%d %H:%M%z")
 
         # format instrument data to CSV
-        instrument_data = "{},{},{},{}\n".format(*instrument_data_list)
+        instrument_data = "{},{},{},{}".format(instrument_name, record_time, *processed_record[2:])
+
+        # the key path only changes once a day, so it's only built once a day per instrument
+        day_key = (instrument_name, UNIX_time // MICROSECONDS_PER_DAY)
+        key_path = self.key_path_cache.get(day_key)
 
-        # create key path in format INSTRUMENT_NAME/YEAR/MONTH/DAY
-        key_path = "{}/{}/{}/{}/TODAYS-DATA.csv".format(instrument_name, *time_list)
+        if key_path is None:
+            # create key path in format INSTRUMENT_NAME/YEAR/MONTH/DAY
+            key_path = "{}/{}/TODAYS-DATA-PT.csv".format(instrument_name, record_datetime.strftime("%Y/%m/%d"))
+            self.key_path_cache[day_key] = key_path
 
-        # get key
-        todays_data_file = self.bucket.get_key(key_path)
+        return key_path, instrument_data
+
+    def send_records(self, processed_records):
+        """
+        Appends a batch of processed records to the CSVs on S3.
+        Records are grouped by key so each CSV is read and written once per batch.
+
+        :param processed_records: list of processed records
+        :return: void
+        """
+
+        # group the CSV rows by the file they belong in
+        rows_by_key = defaultdict(list)
+
+        for processed_record in processed_records:
+            key_path, instrument_data = self.format_record(processed_record)
+            rows_by_key[key_path].append(instrument_data)
+
+        # write every file concurrently and wait for them all to finish
+        list(self.flush_executor.map(self.flush, rows_by_key.keys(), rows_by_key.values()))
+
+    def flush(self, key_path, rows):
+        """
+        Appends CSV rows to a file on S3, creating it if it doesn't exist yet.
+
+        :param key_path: key of the CSV file on S3
+        :param rows: list of CSV rows
+        :return: void
+        """
+
+        new_data = "\n".join(rows) + "\n"
+
+        # get key, only asking S3 whether it exists if we haven't written it ourselves
+        if key_path in self.known_keys:
+            todays_data_file = self.bucket.new_key(key_path)
+
+        else:
+            todays_data_file = self.bucket.get_key(key_path)
 
         # check if the data file exists already
         if todays_data_file:
-            # get all of todays data as a string
-            todays_data_as_string = todays_data_file.get_contents_as_string()
-
-            # append the new data to it
-            todays_data_as_string += instrument_data
+            # get all of todays data as a string and append the new data to it
+            todays_data_as_string = todays_data_file.get_contents_as_string().decode() + new_data
 
             # push the new data to s3
             todays_data_file.set_contents_from_string(todays_data_as_string)
@@ -116,12 +184,10 @@ class ForexConsumerProcessed(KinesisConsumer):
             # create a new data file
             todays_data_file = self.bucket.new_key(key_path)
 
-            # start it with the bit of data
-            todays_data_file.set_contents_from_string(instrument_data)
+            # start it with the batch of data
+            todays_data_file.set_contents_from_string(new_data)
 
-    def send_records(self, processed_records):
-        for record in processed_records:
-            self.send_record(record)
+        self.known_keys.add(key_path)
 
 
 def main():
@@ -34,23 +34,29 @@ class ForexConsumerRaw(KinesisConsumer):
         :return: True if it's valid, False if it's not
         """
 
+        data = record['Data']
+
+        # the prices key won't exist if the record is bad, which can be seen without parsing it
+        if (b'"prices"' if isinstance(data, bytes) else '"prices"') not in data:
+            return False
+
         try:
-            # the prices key won't exist if the record is bad
-            json.loads(record['Data'])['prices'][0]
-            return True
+            return bool(json.loads(data).get('prices'))
 
-        except KeyError:
+        except ValueError:
             return False
 
     def process_record(self, record):
         """
-        Minimal preprocessing. Just convert from JSON to string so it can be written to S3.
+        Minimal preprocessing. The record data is already a JSON string, so it's written to S3 as is.
 
-        :param record: JSON object for record
-        :return: record converted to string
+        :param record: Kinesis record
+        :return: record data as a string
         """
 
-        return json.dumps(record)
+        data = record['Data']
+
+        return data.decode() if isinstance(data, bytes) else data
 
     def send_records(self, processed_records):
         """
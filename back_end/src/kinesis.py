@@ -5,27 +5,75 @@ Abstract classes for Kinesis consumers and producers.
 import time
 
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from boto.kinesis.exceptions import ProvisionedThroughputExceededException
+
+
+# how many times a batch is put before giving up on the records that keep failing
+PUT_RECORDS_ATTEMPTS = 5
 
 
 class KinesisProducer:
     __metaclass__ = ABCMeta
 
-    def __init__(self, client, stream_name, partition_key):
+    def __init__(self, client, stream_name, partition_key, sleep_period):
         # boto kinesis client object
         self.client = client
         # stream name to send data to
         self.stream_name = stream_name
         # key to partition data on
         self.partition_key = partition_key
+        # how long to wait between pulls
+        self.sleep_period = sleep_period
 
     @abstractmethod
     def pull(self):
         pass
 
+    def send_records(self, records):
+        """
+        Sends records to the stream in one request. PutRecords reports throttled or failed
+        entries in the response instead of raising, so those are retried a few times and
+        an error is raised if some still haven't gone through.
+
+        :param records: list of record payloads
+        :return: void
+        """
+
+        retry_wait = 1
+
+        for attempt in range(PUT_RECORDS_ATTEMPTS):
+            # boto base64 encodes the data of the entries it's given in place,
+            # so every attempt gets fresh entries built from the original payloads
+            entries = [{'Data': record, 'PartitionKey': self.partition_key} for record in records]
+
+            response = self.client.put_records(records=entries, stream_name=self.stream_name)
+
+            if not response['FailedRecordCount']:
+                return
+
+            # results are in the same order as the records sent
+            records = [record for record, result in zip(records, response['Records']) if 'ErrorCode' in result]
+
+            # back off before retrying, up to 30 seconds if AWS keeps getting mad at us
+            if attempt < PUT_RECORDS_ATTEMPTS - 1:
+                time.sleep(retry_wait)
+                retry_wait = min(retry_wait * 2, 30)
+
+        raise RuntimeError("{} records couldn't be put to {} after {} attempts"
+                           .format(len(records), self.stream_name, PUT_RECORDS_ATTEMPTS))
+
     def run(self):
         while True:
-            for record in self.pull():
-                self.client.put_record(self.stream_name, record, self.partition_key)
+            # send everything pulled in one request
+            records = list(self.pull())
+
+            if records:
+                self.send_records(records)
+
+            # wait until the next pull once this one has been sent
+            time.sleep(self.sleep_period)
 
 
 class KinesisConsumer:
@@ -46,6 +94,8 @@ class KinesisConsumer:
         self.begin_read = begin_read
         # first shard iterator
         self.shard_iterator = self.client.get_shard_iterator(self.stream_name, self.shard_id, "LATEST")["ShardIterator"]
+        # background worker that sends batches while the next one is being pulled
+        self.send_executor = ThreadPoolExecutor(max_workers=1)
 
     def pull(self):
         """
@@ -68,9 +118,6 @@ class KinesisConsumer:
                     # yield to the main run method
                     yield self.process_record(record)
 
-            # pull every 60 seconds
-            time.sleep(self.sleep_period)
-
         except ProvisionedThroughputExceededException:
             # wait another 30 seconds if AWS gets mad at us
             time.sleep(30)
@@ -116,15 +163,27 @@ class KinesisConsumer:
 
         Continuously loops on the pull() generator which returns records
         from the Kinesis stream, processes them, and sends them on their way
-        as defined.
+        as defined. Each batch is handed to a background worker as soon as
+        it's pulled, so sending it overlaps with the wait for the next pull.
 
         :return: void
         """
 
+        pending_send = None
+
         while True:
             processed_records = []
 
             for processed_record in self.pull():
                 processed_records.append(processed_record)
 
-                self.send_records(processed_records)
\ No newline at end of file
+            # send the whole batch at once
+            if processed_records:
+                # make sure the previous batch went through before queueing another
+                if pending_send is not None:
+                    pending_send.result()
+
+                pending_send = self.send_executor.submit(self.send_records, processed_records)
+
+            # pull every sleep_period seconds, waiting only once the batch is on its way
+            time.sleep(self.sleep_period)
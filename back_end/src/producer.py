@@ -2,7 +2,7 @@
 
 Producer for Forex Kinesis stream.
 
-This will spawn 11 processes and pull exchange data from the Oanda API.
+This will concurrently pull exchange data for 11 instruments from the Oanda API.
 The JSON response will be pushed to the Kinesis stream "forex_stream",
 where it will then be consumed by two consumers, one that pre-processes
 the data and another that simply dumps it to S3.
@@ -25,62 +25,78 @@ SUPPORTED CURRENCIES:
 
 
 import os
-import json
-import time
+import asyncio
 
 import yaml
-import requests
+import aiohttp
 
 from boto import kinesis
-from pathos.multiprocessing import ProcessingPool as Pool
 
 from kinesis import KinesisProducer
 
+# use the libyaml parser when it's available
+try:
+    from yaml import CSafeLoader as SafeLoader
+
+except ImportError:
+    from yaml import SafeLoader
+
 
 class ForexProducer(KinesisProducer):
-    def __init__(self, client, stream_name, partition_key, currencies, multi_pool):
-        super(ForexProducer, self).__init__(client, stream_name, partition_key)
+    def __init__(self, client, stream_name, partition_key, sleep_period, currencies):
+        super(ForexProducer, self).__init__(client, stream_name, partition_key, sleep_period)
         self.currencies = currencies
-        self.multi_pool = multi_pool
-        self.credentials = yaml.load(open(os.path.expanduser('../../credentials.yml')))
+
+        with open(os.path.expanduser('../../credentials.yml')) as f:
+            self.credentials = yaml.load(f, Loader=SafeLoader)
+
         self.API_KEY = self.credentials['oanda']['api_key']
         self.request_header = {'Authorization': 'Bearer {}'.format(self.API_KEY), 'X-Accept-Datetime-Format': 'UNIX'}
 
-    def get_exchange_rate(self, currency_pair):
+    async def get_exchange_rate(self, session, currency_pair):
         """
         Returns the exchange rate for a given currency pair from the Oanda API.
 
+        param: session - aiohttp session with the api_key in its headers
         param: currency_pair - pair in format XXX_XXX is the three letter code for some currency
-        param: request_header - header with the api_key
         return: json object with time and bid/ask
         """
 
         api_endpoint = "https://api-fxpractice.oanda.com/v1/prices?instruments={}".format(currency_pair)
 
-        return requests.get(api_endpoint, headers=self.request_header).text
+        async with session.get(api_endpoint) as response:
+            return await response.text()
+
+    async def get_all_exchange_rates(self):
+        """
+        Returns the exchange rates for all currency pairs, requested concurrently.
+
+        return: list of json objects with time and bid/ask, in the same order as self.currencies
+        """
+
+        async with aiohttp.ClientSession(headers=self.request_header) as session:
+            return await asyncio.gather(*[self.get_exchange_rate(session, currency_pair)
+                                          for currency_pair in self.currencies])
 
     def pull(self):
-        exchange_data = self.multi_pool.map(self.get_exchange_rate, self.currencies)
+        exchange_data = asyncio.run(self.get_all_exchange_rates())
 
+        # the API already responds with a JSON string
         for exchange_rate in exchange_data:
-            yield json.dumps(json.loads(exchange_rate))
-
-        time.sleep(60)
+            yield exchange_rate
 
 
 def main():
     kinesis_client = kinesis.connect_to_region("us-east-1")
     stream_name = "forex_stream"
     partition_key = "filler"
-
-    # instantiate multiprocessing object
-    multi_pool = Pool(11)
+    sleep_period = 60
 
     # get currency exchange rates
     currencies = ['EUR_USD', 'USD_CAD', 'USD_MXN', 'GBP_USD', 'AUD_USD',
                   'USD_JPY', 'USD_CNH', 'USD_INR', 'USD_SAR', 'USD_ZAR', 'XAU_USD']
 
-    forex_producer = ForexProducer(kinesis_client, stream_name, partition_key, currencies, multi_pool)
+    forex_producer = ForexProducer(kinesis_client, stream_name, partition_key, sleep_period, currencies)
 
     forex_producer.run()
 
@@ -1,143 +1,162 @@
+import io
 import os
+import csv
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
-from decimal import Decimal
 
+import boto
 import psycopg2
 import yaml
 
-from pyspark import SparkContext
+from boto.s3.prefix import Prefix
+from psycopg2 import sql
 
+from pyspark import SparkConf
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+from pyspark.sql.types import StructType, StructField, StringType, TimestampType, DecimalType
 
-def get_yesterdays_date():
-    """
-    Provides yesterdays date at the time of calling.
-    return: list, yesterdays_date in format [year, month, day]
-    """
+# use the libyaml parser when it's available
+try:
+    from yaml import CSafeLoader as SafeLoader
 
-    return date.today() - timedelta(days=1)
+except ImportError:
+    from yaml import SafeLoader
 
 
-def get_directory_path(date):
-    """
-    Takes date and currency and returns the associate S3 directory.
+# layout of the processed CSVs, given up front so spark doesn't have to infer it
+# time stamps are parsed once on read, with their UTC offset, so comparing them is a comparison of instants
+# prices are decimal, which is compatible with the numeric type in postgres
+DAILY_DATA_SCHEMA = StructType([StructField("currency", StringType()),
+                                StructField("ts", TimestampType()),
+                                StructField("bid", DecimalType(38, 18)),
+                                StructField("ask", DecimalType(38, 18))])
 
-    param: currency - string, one of the valid currencies
-    param: date - list, desired date as a list in format [year, month, day]
+# name of each currency's daily CSV, as written by the processed consumer
+DAILY_FILE_NAME = "TODAYS-DATA-PT.csv"
 
-    return: S3 directory associated with the given currency on the given date.
-    """
+# columns of every currency's table, in the order they're loaded
+TABLE_COLUMNS = ('date', 'open_bid', 'open_ask', 'max_bid', 'max_ask', 'min_bid', 'min_ask', 'close_bid', 'close_ask')
 
-    directory = "s3a://forex-processed-data/*/{}/{}/{}/*".format(*date.strftime('%Y %m %d').split())
+# number of currencies the producer pulls
+N_CURRENCIES = 11
 
-    return directory
+# kryo and lz4 cut down the bytes shuffled, and there are only ever a few groups to shuffle into
+SPARK_SETTINGS = [('spark.serializer', 'org.apache.spark.serializer.KryoSerializer'),
+                  ('spark.shuffle.file.buffer', '64k'),
+                  ('spark.shuffle.compress', 'true'),
+                  ('spark.shuffle.spill.compress', 'true'),
+                  ('spark.io.compression.codec', 'lz4'),
+                  ('spark.sql.shuffle.partitions', str(N_CURRENCIES * 4)),
+                  ('spark.sql.adaptive.enabled', 'true'),
+                  # the input is lots of small objects, so fetch several at once and read ahead
+                  ('spark.hadoop.fs.s3a.prefetch.enabled', 'true'),
+                  ('spark.hadoop.fs.s3a.prefetch.block.size', '8M'),
+                  ('spark.hadoop.fs.s3a.prefetch.block.count', '8'),
+                  ('spark.hadoop.fs.s3a.connection.maximum', '200'),
+                  ('spark.hadoop.fs.s3a.threads.max', '64'),
+                  ('spark.hadoop.fs.s3a.experimental.input.fadvise', 'sequential')]
 
 
-def parse_csv_to_rdd(spark_context, csv_dir):
-    """
-    Parses a standard CSV to an RDD using spark context.
+def get_yesterdays_date():
     """
-
-    return spark_context.textFile(csv_dir).flatMap(lambda x: x.split("\n")).map(lambda x: x.split(","))
-
-
-def get_opening_values(rdd):
+    Provides yesterdays date at the time of calling.
+    return: list, yesterdays_date in format [year, month, day]
     """
-    return opening values grouped by currency
 
-    input RDD format: key-value pairs
+    return date.today() - timedelta(days=1)
 
-    key: currency
-    value: (datetime, price)
 
-    param: rdd - rdd we want to get the opening value for
-    return: key value pair with the minimum datetime, grouped by currency
+def get_file_paths(bucket, date):
     """
+    Takes date and returns the S3 paths of every currency's CSV for that date.
+    Only the current file name is read, so files in an older format under the same day are skipped.
+    Keys are listed on the driver, one currency at a time in parallel, instead of having
+    spark glob the whole bucket.
 
-    return rdd.reduceByKey(lambda x, y: min(x, y, key=lambda x: x[0][-2:])).collect()
-
+    param: bucket - boto S3 bucket with the processed data
+    param: date - desired date
 
-def get_closing_values(rdd):
+    return: list of S3 paths associated with the given date.
     """
-    return closing values grouped by currency
 
-    input RDD format: key-value pairs
+    day_path = date.strftime('%Y/%m/%d')
 
-    key: currency
-    value: (datetime, price)
+    # the top level of the bucket is one prefix per currency
+    currency_prefixes = [item.name for item in bucket.list(delimiter='/') if isinstance(item, Prefix)]
 
-    param: rdd - rdd we want to get the opening value for
-    return: key value pair with the maximum datetime
-    """
+    def list_currency_day(currency_prefix):
+        key_name = "{}{}/{}".format(currency_prefix, day_path, DAILY_FILE_NAME)
 
-    return rdd.reduceByKey(lambda x, y: max(x, y, key=lambda x: x[0][-2:])).collect()
+        return ["s3a://{}/{}".format(bucket.name, key.name)
+                for key in bucket.list(prefix=key_name) if key.name == key_name]
 
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return [path for paths in executor.map(list_currency_day, currency_prefixes) for path in paths]
 
-def get_max_values(rdd):
-    """
-    return max values grouped by currency
-
-    input RDD format: key-value pairs
-
-    key: currency
-    value: (datetime, price)
 
-    param: rdd - rdd we want to get the opening value for
-    return: key value pair with the maximum price
+def parse_csv_to_dataframe(spark, csv_dir):
     """
+    Parses the daily CSVs to a DataFrame using the spark session.
 
-    return rdd.reduceByKey(lambda x, y: max(x, y, key=lambda x: x[1])).collect()
+    param: spark - spark session
+    param: csv_dir - S3 path or list of S3 paths of the CSVs
 
-
-def get_min_values(rdd):
+    return: spark DataFrame with columns currency, ts, bid, ask
     """
-    return min values grouped by currency
-
-    input RDD format: key-value pairs
 
-    key: currency
-    value: (datetime, price)
-
-    param: rdd - rdd we want to get the opening value for
-    return: key value pair with the minimum price
-    """
-    
-    return rdd.reduceByKey(lambda x, y: max(x, y, key=lambda x: x[1])).collect()
+    # a partially written or garbled line is dropped rather than showing up as nulls in the metrics
+    return spark.read.schema(DAILY_DATA_SCHEMA).option("timestampFormat", "yyyy-MM-dd HH:mmZ") \
+        .csv(csv_dir, mode="DROPMALFORMED")
 
 
-def get_relevant_data_from_rdd(bid_rdd, ask_rdd):
+def get_relevant_data_from_dataframe(daily_df):
     """
-    Takes RDD of full daily (minute-to-minute) and returns the daily metrics.
+    Takes DataFrame of full daily (minute-to-minute) data and returns the daily metrics,
+    all computed in a single aggregation.
 
-    param: bid_ask_rdd - spark RDD of either bids or asks
+    param: daily_df - spark DataFrame of the daily data
 
-    return:
+    return: spark DataFrame with the currency and
     open_bid: opening bid
     open_ask: opening ask
 
-    close_bid: closing bid
-    close_ask: clsoing ask
-
     max_bid: maximum bid price over course of the day
     max_ask: maximum ask price over course of the day
 
     min_bid: minimum bid price over course of the day
     min_ask: minimum ask price over course of the day
+
+    close_bid: closing bid
+    close_ask: closing ask
     """
 
-    open_bid = get_opening_values(bid_rdd)
-    open_ask = get_opening_values(ask_rdd)
+    # structs compare on their first field, so the min/max (ts, price) is the opening/closing price
+    return daily_df.groupBy("currency").agg(
+        F.min(F.struct("ts", "bid"))["bid"].alias("open_bid"),
+        F.min(F.struct("ts", "ask"))["ask"].alias("open_ask"),
+        F.max("bid").alias("max_bid"),
+        F.max("ask").alias("max_ask"),
+        F.min("bid").alias("min_bid"),
+        F.min("ask").alias("min_ask"),
+        F.max(F.struct("ts", "bid"))["bid"].alias("close_bid"),
+        F.max(F.struct("ts", "ask"))["ask"].alias("close_ask")
+    )
 
-    max_bid = get_max_values(bid_rdd)
-    max_ask = get_max_values(ask_rdd)
 
-    min_bid = get_min_values(bid_rdd)
-    min_ask = get_min_values(ask_rdd)
+def get_copy_statement(table_name):
+    """
+    Builds the COPY statement for a currency's table.
+
+    param: table_name - name of the currency's table
 
-    close_bid = get_closing_values(bid_rdd)
-    close_ask = get_closing_values(ask_rdd)
+    return: psycopg2 composed SQL statement to use with copy_expert
+    """
 
-    return zip(open_bid, open_ask, max_bid, max_ask, min_bid, min_ask, close_bid, close_ask)
+    return sql.SQL("COPY {table} ({columns}) FROM STDIN WITH (FORMAT CSV)").format(
+        table=sql.Identifier(table_name), columns=sql.SQL(", ").join(map(sql.Identifier, TABLE_COLUMNS)))
 
 
 def push_to_database(instrument_data_list, date, conn):
@@ -145,64 +164,95 @@ def push_to_database(instrument_data_list, date, conn):
     Pushes the daily values for the currency to the database.
     """
 
-    cursor = conn.cursor()
+    # group the values by the table they go in
+    # prices are already decimal, which is compatible with the numeric type in postgres
+    rows_by_table = defaultdict(list)
 
     for instrument_data in instrument_data_list:
         # first value to be inserted is the date
-        db_vals = [date]
+        rows_by_table[instrument_data.currency.lower()].append(
+            (date, instrument_data.open_bid, instrument_data.open_ask, instrument_data.max_bid,
+             instrument_data.max_ask, instrument_data.min_bid, instrument_data.min_ask,
+             instrument_data.close_bid, instrument_data.close_ask))
 
-        instrument_name = instrument_data[0][0]
+    cursor = conn.cursor()
 
-        # get all the data and convert to decimal
-        # decimal is compatible with the numeric type in postgres
-        open_bid = Decimal(instrument_data[0][1][1])
-        open_ask = Decimal(instrument_data[1][1][1])
+    # build each table's statement once, before any loading starts
+    copy_statements = {table_name: get_copy_statement(table_name).as_string(cursor) for table_name in rows_by_table}
 
-        max_bid = Decimal(instrument_data[2][1][1])
-        max_ask = Decimal(instrument_data[3][1][1])
+    # load each table's rows with one COPY and commit everything at once
+    try:
+        for table_name, rows in rows_by_table.items():
+            csv_buffer = io.StringIO()
+            csv.writer(csv_buffer).writerows(rows)
+            csv_buffer.seek(0)
 
-        min_bid = Decimal(instrument_data[4][1][1])
-        min_ask = Decimal(instrument_data[5][1][1])
+            cursor.copy_expert(copy_statements[table_name], csv_buffer)
 
-        close_bid = Decimal(instrument_data[6][1][1])
-        close_ask = Decimal(instrument_data[7][1][1])
+        conn.commit()
 
-        # insert into DB and commit changes
-        db_vals.extend([open_bid, open_ask, max_bid, max_ask, min_bid, min_ask, close_bid, close_ask])
-        cursor.execute("INSERT INTO {} VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)".format(instrument_name.lower()), db_vals)
+    except psycopg2.Error:
+        # don't leave part of a day loaded, spark will retry the whole partition
+        conn.rollback()
+        raise
+
+
+def write_partition(instrument_data_list, date, pg_credentials):
+    """
+    Pushes one partition of the daily values to the database over its own connection.
+
+    param: instrument_data_list - iterator of rows in the partition
+    param: date - date the values are for
+    param: pg_credentials - broadcast dictionary of psycopg2 connection arguments
+    """
+
+    instrument_data_list = list(instrument_data_list)
+
+    # partitions no currency hashed to are empty, don't connect for those
+    if not instrument_data_list:
+        return
+
+    conn = psycopg2.connect(**pg_credentials.value)
+
+    try:
+        push_to_database(instrument_data_list, date, conn)
+
+    finally:
+        conn.close()
 
-        conn.commit()
 
+def main(pg_credentials):
+    # instantiate spark session
+    spark = SparkSession.builder.config(conf=SparkConf().setAll(SPARK_SETTINGS)).getOrCreate()
 
-def main(conn):
-    # instantiate spark context
-    sc = SparkContext()
+    # executors write to the database themselves, so they all need the credentials
+    pg_credentials = spark.sparkContext.broadcast(pg_credentials)
 
-    # get yesterdays date and the corresponding CSV on s3
+    # get yesterdays date and the corresponding CSVs on s3
     yesterdays_date = get_yesterdays_date()
-    s3_dir = get_directory_path(yesterdays_date)
+    s3_paths = get_file_paths(boto.connect_s3().get_bucket("forex-processed-data"), yesterdays_date)
 
-    # parse the CSV into a spark RDD
-    daily_rdd = parse_csv_to_rdd(sc, s3_dir)
-    
-    # split rdd into bids and asks and cache them both
-    bids_rdd = daily_rdd.map(lambda x: (x[0], (x[1], x[2]))).cache()
-    asks_rdd = daily_rdd.map(lambda x: (x[0], (x[1], x[3]))).cache()
+    # parse the CSV into a spark DataFrame
+    daily_df = parse_csv_to_dataframe(spark, s3_paths)
 
-    all_instrument_data = get_relevant_data_from_rdd(bids_rdd, asks_rdd)
+    all_instrument_data = get_relevant_data_from_dataframe(daily_df)
 
-    push_to_database(all_instrument_data, yesterdays_date, conn)
+    # write from the executors instead of collecting everything to the driver,
+    # with each currency on one partition so only one executor loads each table
+    all_instrument_data.repartition(N_CURRENCIES, "currency").rdd \
+        .foreachPartition(lambda rows: write_partition(rows, yesterdays_date, pg_credentials))
 
 
 if __name__ == "__main__":
-    # get postgres credentials and connect to db
-    credentials = yaml.load(open(os.path.expanduser('postgres_credentials.yml')))
+    # get postgres credentials
+    with open(os.path.expanduser('postgres_credentials.yml')) as f:
+        credentials = yaml.load(f, Loader=SafeLoader)
 
     PG_ENDPOINT = 'forex-data.cql5yf8qc4xa.us-east-1.rds.amazonaws.com'
     PG_DB_NAME = credentials['postgres']['db_name']
     PG_USERNAME = credentials['postgres']['username']
     PG_PASSWORD = credentials['postgres']['password']
 
-    pg_conn = psycopg2.connect(host=PG_ENDPOINT, user=PG_USERNAME, password=PG_PASSWORD, dbname=PG_DB_NAME)
+    pg_credentials = {'host': PG_ENDPOINT, 'user': PG_USERNAME, 'password': PG_PASSWORD, 'dbname': PG_DB_NAME}
 
-    main(pg_conn)
+    main(pg_credentials)